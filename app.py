@@ -1,11 +1,49 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 import re
 import json
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import threading
+from collections import OrderedDict
+import diskcache
+import tiktoken
+import numpy as np
 from openai import OpenAI
 from dotenv import load_dotenv
-from typing import List, Dict, Optional
+from typing import List, Dict, Iterator, Optional, Tuple
+
+# Expressions régulières compilées une seule fois
+_INTENT_RE = re.compile(
+    r"(?:cherchons?|recherche|regardons?)\s+(.+?)(?:\s+entre|\s+dans|\s+à|\s+pour|\.|$)",
+    re.IGNORECASE
+)
+_BUDGET_PAT = re.compile(r'entre\s+(\d+)\s*(?:et|à|-)\s*(\d+)', re.IGNORECASE)
+# Montants avec séparateurs de milliers ("1 500", "1.500") pour l'extraction locale
+_AMOUNT = r'(?<![\d.,])(\d{1,3}(?:[ \u00a0\u202f.]\d{3})+|\d+)'
+_CURRENCY = r'(?:€|eur(?:os?)?\b)'
+_CTX_RANGE_PAT = re.compile(
+    rf'\b(?:entre|de)\s+{_AMOUNT}\s*({_CURRENCY})?\s*(?:et|à|-)\s*{_AMOUNT}\s*({_CURRENCY})?', re.IGNORECASE
+)
+_CTX_AMOUNT_PAT = re.compile(rf'{_AMOUNT}\s*{_CURRENCY}', re.IGNORECASE)
+_CTX_BUDGET_WORD_PAT = re.compile(rf'budget\s*(?:de|:|max(?:imum)?)?\s*{_AMOUNT}', re.IGNORECASE)
+_WORD_PAT = re.compile(r"\w+")
+
+KNOWN_BRANDS = {
+    "apple", "samsung", "dyson", "sony", "bose", "xiaomi", "huawei", "lg",
+    "philips", "rowenta", "asus", "lenovo", "hp", "dell", "acer", "jbl",
+    "logitech", "google", "oneplus", "bosch", "moulinex", "seb", "nintendo"
+}
+
+USAGE_KEYWORDS = {
+    "télétravail": "télétravail", "bureau": "bureau", "gaming": "gaming",
+    "jeux": "gaming", "sport": "sport", "running": "sport", "voyage": "voyage",
+    "voyages": "voyage", "études": "études", "étudier": "études",
+    "cuisine": "cuisine", "musique": "musique", "photo": "photo", "vidéo": "vidéo"
+}
 
 # Configuration
 st.set_page_config(
@@ -36,6 +74,8 @@ if not check_api_keys():
     st.stop()
 
 client = OpenAI(api_key=config["openai_key"])
+HISTORY_TOKEN_BUDGET = 6000
+CONTEXT_MARKER = "###CONTEXTE###"
 
 # --- Système conversationnel ---
 ASSISTANT_PERSONA = """
@@ -71,17 +111,41 @@ def extract_price(price_str: str) -> float:
     
     if isinstance(price_str, list):
         price_str = price_str[0] if price_str else "0"
+    price_str = str(price_str)
+    
+    # Le dernier séparateur est le séparateur décimal ("1.234,56" comme "1,234.56")
+    decimal_sep = '.' if price_str.rfind('.') > price_str.rfind(',') else ','
+    
+    digits = []
+    has_decimal = False
+    for char in price_str:
+        if char.isdigit():
+            digits.append(char)
+        elif char == decimal_sep and not has_decimal:
+            digits.append('.')
+            has_decimal = True
+        elif char in "., \u00a0\u202f":
+            continue  # séparateur de milliers
+        elif digits:
+            break  # fin du premier nombre (ex : fourchette "12,99 € - 15,99 €")
     
-    price_clean = re.sub(r'[^\d.,]', '', str(price_str))
-    price_clean = price_clean.replace(',', '.')
-    
-    numbers = re.findall(r'\d+\.?\d*', price_clean)
-    if numbers:
-        try:
-            return float(numbers[0])
-        except ValueError:
-            return 0.0
-    return 0.0
+    try:
+        return float(''.join(digits))
+    except ValueError:
+        return 0.0
+
+def parse_rating(rating) -> float:
+    if isinstance(rating, (int, float)):
+        return float(rating)
+    # Texte du type "4,5 sur 5" : même lecture que pour les prix
+    return extract_price(rating) if isinstance(rating, str) else 0.0
+
+def parse_reviews_count(reviews_count) -> int:
+    if isinstance(reviews_count, (int, float)):
+        return int(reviews_count)
+    if isinstance(reviews_count, str):
+        return int("".join(char for char in reviews_count if char.isdigit()) or 0)
+    return 0
 
 def format_delivery(delivery_info) -> str:
     if not delivery_info:
@@ -92,94 +156,105 @@ def format_delivery(delivery_info) -> str:
     
     return str(delivery_info)[:30]
 
-@st.cache_data(ttl=1800)
+SEARCH_CACHE_TTL = 1800
+
+@st.cache_resource
+def get_worker_pool() -> ThreadPoolExecutor:
+    """Pool partagé pour les appels réseau lancés en tâche de fond."""
+    return ThreadPoolExecutor(max_workers=8)
+
+@st.cache_resource
+def get_http_session() -> requests.Session:
+    """Session HTTP partagée : garde la connexion à SerpAPI ouverte entre les recherches."""
+    session = requests.Session()
+    retry = Retry(total=2, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+    session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry))
+    return session
+
+@st.cache_resource
+def get_search_cache() -> diskcache.Cache:
+    """Cache disque partagé entre les processus Streamlit."""
+    return diskcache.Cache("./.cache")
+
 def fetch_amazon_products(query: str, min_price: float = 0, max_price: float = 1000, num_results: int = 4) -> List[Dict]:
+    # "Aspirateur" et "aspirateur " doivent partager la même entrée de cache
+    query_norm = " ".join(query.split()).lower()
+    return _fetch_amazon_products(query_norm, float(min_price), float(max_price), int(num_results))
+
+@st.cache_data(ttl=SEARCH_CACHE_TTL)
+def _fetch_amazon_products(query_norm: str, min_price: float, max_price: float, num_results: int) -> List[Dict]:
     url = "https://serpapi.com/search.json"
     params = {
         "engine": "amazon",
         "amazon_domain": "amazon.fr",
         "api_key": config["serp_key"],
-        "k": query,
+        "k": query_norm,
         "s": "review-rank",
         "num": num_results * 2
     }
+    
+    cache_params = {key: value for key, value in params.items() if key != "api_key"}
+    cache_params.update({"min_price": min_price, "max_price": max_price})
+    cache_key = hashlib.blake2b(json.dumps(cache_params, sort_keys=True).encode()).hexdigest()
+    
+    disk_cache = get_search_cache()
+    cached = disk_cache.get(cache_key)
+    if cached is not None:
+        return cached
 
     try:
-        response = requests.get(url, params=params, timeout=15)
+        response = get_http_session().get(url, params=params, timeout=(3, 15))
         response.raise_for_status()
         
-        data = response.json()
+        results = response.json().get("organic_results", [])
+        count = len(results)
+        
+        # Données en colonnes : filtre et tri se font en un seul passage NumPy
+        # SerpAPI fournit déjà des valeurs numériques ; le texte du prix ne sert qu'en secours
+        prices = np.fromiter(
+            (
+                float(product["extracted_price"]) if product.get("extracted_price") is not None
+                else extract_price(product.get("price_str") or product.get("price", "0"))
+                for product in results
+            ),
+            dtype=np.float64, count=count
+        )
+        # Valeurs numériques utilisées telles quelles, texte analysé seulement en secours
+        ratings = np.fromiter((parse_rating(product.get("rating")) for product in results), dtype=np.float64, count=count)
+        reviews = np.fromiter(
+            (parse_reviews_count(product.get("reviews") or product.get("ratings_total")) for product in results),
+            dtype=np.int64, count=count
+        )
+        
+        candidates = np.flatnonzero((prices >= min_price) & (prices <= max_price))
+        # Tri décroissant par note puis par nombre d'avis (stable, comme list.sort)
+        order = candidates[np.lexsort((-reviews[candidates], -ratings[candidates]))][:num_results]
+        
+        # Seuls les produits retenus sont reconvertis en dictionnaires pour l'affichage
         products = []
+        for i in order:
+            product = results[i]
+            price_val = float(prices[i])
+            products.append({
+                "title": product.get("title", "Produit sans titre"),
+                "price": price_val,
+                "price_str": f"${price_val:.2f}" if price_val > 0 else "Prix non disponible",
+                "rating": float(ratings[i]),
+                "reviews_count": int(reviews[i]),
+                "link": product.get("link", ""),
+                "description": product.get("snippet", "Description non disponible"),
+                "image": product.get("image", ""),
+                "delivery": product.get("delivery", ""),
+                "prime": product.get("prime", False)
+            })
 
-        for product in data.get("organic_results", []):
-            price_val = extract_price(product.get("price_str") or product.get("price", "0"))
-            
-            if min_price <= price_val <= max_price:
-                rating = product.get("rating", 0)
-                if isinstance(rating, str):
-                    try:
-                        rating = float(rating.split()[0])
-                    except:
-                        rating = 0
-                
-                reviews_count = product.get("ratings_total", 0)
-                if isinstance(reviews_count, str):
-                    reviews_count = int(re.sub(r'[^\d]', '', reviews_count) or 0)
-
-                products.append({
-                    "title": product.get("title", "Produit sans titre"),
-                    "price": price_val,
-                    "price_str": f"${price_val:.2f}" if price_val > 0 else "Prix non disponible",
-                    "rating": rating,
-                    "reviews_count": reviews_count,
-                    "link": product.get("link", ""),
-                    "description": product.get("snippet", "Description non disponible"),
-                    "image": product.get("image", ""),
-                    "delivery": product.get("delivery", ""),
-                    "prime": product.get("prime", False)
-                })
-
-        products.sort(key=lambda x: (x["rating"], x["reviews_count"]), reverse=True)
-        return products[:num_results]
+        disk_cache.set(cache_key, products, expire=SEARCH_CACHE_TTL)
+        return products
 
     except Exception as e:
         st.error(f"⚠️ Erreur recherche : {str(e)}")
         return []
 
-def chat_with_assistant(user_message: str, conversation_history: List[Dict], user_context: Dict) -> str:
-    """Chat principal avec l'assistant qui gère tout le parcours d'achat."""
-    
-    # Construction du contexte
-    context_info = f"""
-    CONTEXTE UTILISATEUR ACTUEL :
-    {json.dumps(user_context, indent=2, ensure_ascii=False)}
-    
-    HISTORIQUE RÉCENT :
-    {json.dumps(conversation_history[-4:] if len(conversation_history) > 4 else conversation_history, indent=2, ensure_ascii=False)}
-    """
-    
-    messages = [
-        {"role": "system", "content": ASSISTANT_PERSONA + "\n\n" + context_info},
-    ]
-    
-    # Ajouter l'historique récent
-    for msg in conversation_history[-6:]:  # Garde les 6 derniers messages
-        messages.append(msg)
-    
-    # Message actuel
-    messages.append({"role": "user", "content": user_message})
-    
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=messages,
-            max_tokens=400,
-            temperature=0.8
-        )
-        return response.choices[0].message.content.strip()
-    except Exception as e:
-        return f"Désolé, j'ai un problème technique : {str(e)}"
-
 def extract_search_intent(conversation_history: List[Dict]) -> Optional[Dict]:
     """Détecte si l'assistant veut faire une recherche produit."""
     
@@ -188,32 +263,55 @@ def extract_search_intent(conversation_history: List[Dict]) -> Optional[Dict]:
         
     last_message = conversation_history[-1].get('content', '')
     
-    # Recherche de patterns indiquant une recherche
-    search_patterns = [
-        r"cherchons?\s+(.+?)(?:\s+entre|\s+dans|\s+à|\s+pour|\.|$)",
-        r"recherche\s+(.+?)(?:\s+entre|\s+dans|\s+à|\s+pour|\.|$)",
-        r"regardons?\s+(.+?)(?:\s+entre|\s+dans|\s+à|\s+pour|\.|$)"
-    ]
+    # Recherche de patterns indiquant une recherche, en un seul passage
+    match = _INTENT_RE.search(last_message)
+    if not match:
+        return None
     
-    for pattern in search_patterns:
-        match = re.search(pattern, last_message.lower())
-        if match:
-            query = match.group(1).strip()
-            
-            # Extraction du budget si mentionné
-            budget_match = re.search(r'entre\s+(\d+)\s*(?:et|à|-)\s*(\d+)', last_message.lower())
-            min_price = float(budget_match.group(1)) if budget_match else 0
-            max_price = float(budget_match.group(2)) if budget_match else 1000
-            
-            return {
-                "query": query,
-                "min_price": min_price,
-                "max_price": max_price
-            }
+    query = match.group(1).strip()
     
-    return None
+    # Extraction du budget si mentionné
+    budget_match = _BUDGET_PAT.search(last_message)
+    min_price = float(budget_match.group(1)) if budget_match else 0
+    max_price = float(budget_match.group(2)) if budget_match else 1000
+    
+    return {
+        "query": query,
+        "min_price": min_price,
+        "max_price": max_price
+    }
+
+ANALYSIS_UNAVAILABLE = "Analyse en cours..."
+ANALYSIS_FAILED = "😕 Je n'ai pas pu analyser ce produit pour le moment."
+ANALYSIS_CACHE_SIZE = 512
+
+class AnalysisCache:
+    """Cache LRU borné des analyses, partagé entre les sessions et les threads."""
+    
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key: Tuple) -> Optional[str]:
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+    
+    def set(self, key: Tuple, value: str) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+@st.cache_resource(show_spinner=False)
+def get_analysis_cache() -> AnalysisCache:
+    return AnalysisCache(ANALYSIS_CACHE_SIZE)
 
-def analyze_product_conversational(product: Dict, user_context: Dict) -> str:
+def analyze_product_conversational(product: Dict, user_context_json: str) -> str:
     """Analyse un produit dans le style conversationnel."""
     
     prompt = f"""
@@ -223,7 +321,7 @@ def analyze_product_conversational(product: Dict, user_context: Dict) -> str:
     Prix : {product['price_str']} | Note : {product['rating']}/5 | Avis : {product['reviews_count']}
     Description : {product['description']}
 
-    PROFIL CLIENT : {json.dumps(user_context, ensure_ascii=False)}
+    PROFIL CLIENT : {user_context_json}
 
     Donne ton avis en 2-3 phrases comme si tu parlais à un ami :
     - Pourquoi ça match avec ses besoins (ou pas)
@@ -242,7 +340,138 @@ def analyze_product_conversational(product: Dict, user_context: Dict) -> str:
         )
         return response.choices[0].message.content.strip()
     except:
-        return "Analyse en cours..."
+        return ANALYSIS_FAILED
+
+def analyze_product(product: Dict, user_context_json: str, cache: AnalysisCache) -> str:
+    """Analyse un produit en réutilisant l'avis déjà généré pour ce même profil."""
+    
+    context_hash = hashlib.blake2b(user_context_json.encode(), digest_size=8).hexdigest()
+    key = (product['title'], product['price_str'], product['rating'], product['reviews_count'], context_hash)
+    
+    analysis = cache.get(key)
+    if analysis is None:
+        analysis = analyze_product_conversational(product, user_context_json)
+        if analysis != ANALYSIS_FAILED:
+            cache.set(key, analysis)
+    return analysis
+
+def update_user_context(updates: Dict) -> None:
+    """Fusionne les nouvelles infos et ne re-sérialise le contexte qu'à ce moment-là."""
+    st.session_state.user_context.update(updates)
+    st.session_state.user_context_json = json.dumps(
+        st.session_state.user_context, ensure_ascii=False, sort_keys=True
+    )
+
+def run_product_search(search_intent: Dict) -> None:
+    """Lance la recherche demandée par Alex et garde les résultats en session."""
+    
+    products = fetch_amazon_products(
+        search_intent['query'], 
+        search_intent['min_price'], 
+        search_intent['max_price']
+    )
+    # Les résultats restent affichés tant que l'utilisateur n'a pas répondu ; l'identifiant
+    # rend les clés des boutons propres à chaque recherche
+    search_id = st.session_state.get('search_count', 0) + 1
+    st.session_state.search_count = search_id
+    st.session_state.search_results = {"id": search_id, "query": search_intent['query'], "products": products}
+    st.session_state.analyses = {}
+    
+    if products:
+        st.session_state.conversation.append({"role": "assistant", "content": f"Recherche effectuée pour '{search_intent['query']}' - {len(products)} produits trouvés"})
+
+@st.fragment
+def render_search_results() -> None:
+    """Affiche les résultats ; un clic sur « Générer l'avis » ne relance que ce bloc."""
+    
+    search_results = st.session_state.search_results
+    products = search_results['products']
+    analyses = st.session_state.analyses
+    
+    with st.chat_message("assistant", avatar="🤖"):
+        st.markdown(f"🔍 Parfait ! Je cherche **{search_results['query']}** pour vous...")
+        
+        if products:
+            st.markdown(f"J'ai trouvé {len(products)} produits qui pourraient vous intéresser. Laissez-moi vous les présenter :")
+            
+            # Récupéré ici, sur le thread du script : le pool n'a pas de contexte Streamlit
+            analysis_cache = get_analysis_cache()
+            
+            # Seule l'option 1, ouverte par défaut, est analysée d'office,
+            # pendant l'affichage des fiches produits
+            top_future = None
+            if 1 not in analyses:
+                top_future = get_worker_pool().submit(
+                    analyze_product, products[0], st.session_state.user_context_json, analysis_cache
+                )
+            top_slot = None
+            
+            for i, product in enumerate(products, 1):
+                with st.expander(f"🏆 Option {i} : {product['title'][:70]}...", expanded=i == 1):
+                    
+                    col_main, col_image = st.columns([3, 1])
+                    
+                    with col_main:
+                        # Infos essentielles
+                        info_cols = st.columns(3)
+                        with info_cols[0]:
+                            st.metric("💰 Prix", product['price_str'])
+                        with info_cols[1]:
+                            st.metric("⭐ Note", f"{product['rating']:.1f}/5")
+                        with info_cols[2]:
+                            st.metric("📝 Avis", f"{product['reviews_count']:,}")
+                        
+                        # Livraison
+                        delivery_text = format_delivery(product.get('delivery'))
+                        if product.get('prime'):
+                            st.markdown("🚚 **Prime** - Livraison gratuite rapide")
+                        else:
+                            st.markdown(f"🚚 **Livraison :** {delivery_text}")
+                        
+                        # Analyse personnalisée, générée à la demande pour les options repliées
+                        st.markdown("**🤖 Mon avis pour vous :**")
+                        if i in analyses:
+                            st.info(analyses[i])
+                        elif i == 1:
+                            top_slot = st.empty()
+                            top_slot.info(ANALYSIS_UNAVAILABLE)
+                        elif st.button("🤖 Générer l'avis d'Alex", key=f"gen_{search_results['id']}_{i}"):
+                            with st.spinner("Alex analyse ce produit..."):
+                                analysis = analyze_product(product, st.session_state.user_context_json, analysis_cache)
+                            # Un échec n'est pas mémorisé : le bouton reste là pour réessayer
+                            if analysis != ANALYSIS_FAILED:
+                                analyses[i] = analysis
+                                st.rerun(scope="fragment")
+                            st.warning(analysis)
+                        
+                        # Lien Amazon
+                        st.markdown(f"[🛒 **Voir sur Amazon**]({product['link']})")
+                    
+                    with col_image:
+                        if product.get('image'):
+                            st.image(product['image'], width=180)
+            
+            if top_future is not None:
+                analysis = top_future.result()
+                if analysis == ANALYSIS_FAILED:
+                    top_slot.warning(analysis)  # relancée au prochain affichage
+                else:
+                    analyses[1] = analysis
+                    top_slot.info(analysis)
+            
+            # Invite à continuer la conversation
+            followup_msg = """
+            Voilà mes suggestions ! 😊
+            
+            Qu'est-ce que vous en pensez ? Avez-vous des questions sur l'un de ces produits ? 
+            Ou souhaitez-vous que je vous aide à affiner votre recherche ?
+            """
+            
+            st.markdown(followup_msg)
+        
+        else:
+            st.warning("😔 Je n'ai pas trouvé de produits dans cette gamme de prix.")
+            st.markdown("Voulez-vous que je cherche dans une autre gamme de prix ou avec d'autres termes ?")
 
 # --- Interface principale ---
 def main():
@@ -253,6 +482,7 @@ def main():
     if 'conversation' not in st.session_state:
         st.session_state.conversation = []
         st.session_state.user_context = {}
+        st.session_state.user_context_json = "{}"
         # Message de bienvenue
         welcome_msg = """
         Salut ! 👋 Je suis Alex, votre conseiller d'achat personnel.
@@ -266,6 +496,12 @@ def main():
         """
         st.session_state.conversation.append({"role": "assistant", "content": welcome_msg})
     
+    # Zone de saisie, lue avant l'affichage : un nouveau message remplace les anciens
+    # résultats, qui ne doivent pas être dessinés une seconde fois dans ce passage
+    user_input = st.chat_input("Tapez votre message ici... 💬")
+    if user_input:
+        st.session_state.search_results = None
+    
     # Zone de conversation
     chat_container = st.container()
     
@@ -279,100 +515,44 @@ def main():
                 with st.chat_message("assistant", avatar="🤖"):
                     st.markdown(message["content"])
         
-        # Vérification si recherche produit demandée
-        search_intent = extract_search_intent(st.session_state.conversation)
-        if search_intent and not st.session_state.get('products_shown', False):
-            
-            st.session_state.products_shown = True
-            
-            with st.chat_message("assistant", avatar="🤖"):
-                st.markdown(f"🔍 Parfait ! Je cherche **{search_intent['query']}** pour vous...")
-                
-                products = fetch_amazon_products(
-                    search_intent['query'], 
-                    search_intent['min_price'], 
-                    search_intent['max_price']
-                )
-                
-                if products:
-                    st.markdown(f"J'ai trouvé {len(products)} produits qui pourraient vous intéresser. Laissez-moi vous les présenter :")
-                    
-                    for i, product in enumerate(products, 1):
-                        with st.expander(f"🏆 Option {i} : {product['title'][:70]}...", expanded=i == 1):
-                            
-                            col_main, col_image = st.columns([3, 1])
-                            
-                            with col_main:
-                                # Infos essentielles
-                                info_cols = st.columns(3)
-                                with info_cols[0]:
-                                    st.metric("💰 Prix", product['price_str'])
-                                with info_cols[1]:
-                                    st.metric("⭐ Note", f"{product['rating']:.1f}/5")
-                                with info_cols[2]:
-                                    st.metric("📝 Avis", f"{product['reviews_count']:,}")
-                                
-                                # Livraison
-                                delivery_text = format_delivery(product.get('delivery'))
-                                if product.get('prime'):
-                                    st.markdown("🚚 **Prime** - Livraison gratuite rapide")
-                                else:
-                                    st.markdown(f"🚚 **Livraison :** {delivery_text}")
-                                
-                                # Analyse personnalisée
-                                st.markdown("**🤖 Mon avis pour vous :**")
-                                analysis = analyze_product_conversational(product, st.session_state.user_context)
-                                st.info(analysis)
-                                
-                                # Lien Amazon
-                                st.markdown(f"[🛒 **Voir sur Amazon**]({product['link']})")
-                            
-                            with col_image:
-                                if product.get('image'):
-                                    st.image(product['image'], width=180)
-                    
-                    # Invite à continuer la conversation
-                    followup_msg = """
-                    Voilà mes suggestions ! 😊
-                    
-                    Qu'est-ce que vous en pensez ? Avez-vous des questions sur l'un de ces produits ? 
-                    Ou souhaitez-vous que je vous aide à affiner votre recherche ?
-                    """
-                    
-                    st.markdown(followup_msg)
-                    st.session_state.conversation.append({"role": "assistant", "content": f"Recherche effectuée pour '{search_intent['query']}' - {len(products)} produits trouvés"})
-                
-                else:
-                    st.warning("😔 Je n'ai pas trouvé de produits dans cette gamme de prix.")
-                    st.markdown("Voulez-vous que je cherche dans une autre gamme de prix ou avec d'autres termes ?")
-    
-    # Zone de saisie
-    user_input = st.chat_input("Tapez votre message ici... 💬")
+        # Résultats de la dernière recherche
+        if st.session_state.get('search_results'):
+            render_search_results()
     
     if user_input:
         # Ajouter le message utilisateur
         st.session_state.conversation.append({"role": "user", "content": user_input})
         
-        # Réinitialiser le flag des produits pour permettre de nouvelles recherches
-        st.session_state.products_shown = False
+        # Infos simples extraites localement, visibles par Alex dès cette réponse
+        local_update = cheap_context_delta(user_input)
+        if local_update:
+            update_user_context(local_update)
         
-        # Génération de la réponse
-        with st.spinner("Alex réfléchit..."):
-            response = chat_with_assistant(
-                user_input, 
-                st.session_state.conversation[:-1],  # Sans le dernier message
-                st.session_state.user_context
-            )
+        with st.chat_message("user"):
+            st.markdown(user_input)
         
-        # Mise à jour du contexte utilisateur via IA
-        context_update = update_user_context(user_input, st.session_state.user_context)
+        # Génération de la réponse, affichée au fil de l'eau
+        reply_stream, context_update = chat_with_assistant(
+            user_input, 
+            st.session_state.conversation[:-1],  # Sans le dernier message
+            st.session_state.user_context_json
+        )
+        with st.chat_message("assistant", avatar="🤖"):
+            response = st.write_stream(reply_stream)
+        
+        # Mise à jour du contexte utilisateur avec les infos extraites par l'IA
         if context_update:
-            st.session_state.user_context.update(context_update)
+            update_user_context(context_update)
         
         # Ajouter la réponse
-        st.session_state.conversation.append({"role": "assistant", "content": response})
+        st.session_state.conversation.append({"role": "assistant", "content": response.strip()})
         
-        st.rerun()
+        # Seule la nouvelle réponse d'Alex peut déclencher une recherche, affichée
+        # directement à la suite sans relancer tout le script
+        search_intent = extract_search_intent(st.session_state.conversation)
+        if search_intent:
+            run_product_search(search_intent)
+            render_search_results()
     
     # Sidebar avec contexte utilisateur
     with st.sidebar:
@@ -385,11 +565,14 @@ def main():
         else:
             st.markdown("*Je découvre vos besoins au fur et à mesure de notre conversation...*")
         
+        history_tokens = sum(count_message_tokens(st.session_state.conversation))
+        st.caption(f"🧮 Conversation : {history_tokens:,} tokens (historique envoyé limité à {HISTORY_TOKEN_BUDGET:,})")
+        
         st.markdown("---")
         
         # Bouton reset
         if st.button("🔄 Nouvelle conversation"):
-            for key in ['conversation', 'user_context', 'products_shown']:
+            for key in ['conversation', 'user_context', 'user_context_json', 'search_results', 'search_count', 'analyses']:
                 if key in st.session_state:
                     del st.session_state[key]
             st.rerun()
@@ -404,75 +587,156 @@ def main():
         - "Vous avez des conseils pour un cadeau ?"
         """)
 
-def update_user_context(user_message: str, current_context: Dict) -> Dict:
-    """Met à jour le contexte utilisateur basé sur son message."""
+def _amount(text: str) -> int:
+    return int("".join(char for char in text if char.isdigit()))
+
+def _extract_budget(user_message: str) -> Optional[str]:
+    """Budget mentionné, seulement avec une devise ou juste après le mot « budget »."""
+    
+    # Une fourchette sans contexte ("entre 2 et 3 personnes") n'est pas un budget
+    range_match = _CTX_RANGE_PAT.search(user_message)
+    if range_match:
+        before = user_message[max(0, range_match.start() - 30):range_match.start()]
+        if range_match.group(2) or range_match.group(4) or "budget" in before.lower():
+            return f"{_amount(range_match.group(1))}-{_amount(range_match.group(3))} €"
+    
+    amount_match = _CTX_AMOUNT_PAT.search(user_message) or _CTX_BUDGET_WORD_PAT.search(user_message)
+    if amount_match:
+        return f"{_amount(amount_match.group(1))} €"
+    return None
+
+def cheap_context_delta(user_message: str) -> Dict:
+    """Extrait localement les infos simples (budget, marque, usage) sans appel IA."""
     
-    prompt = f"""
-    Message utilisateur : "{user_message}"
-    Contexte actuel : {json.dumps(current_context, ensure_ascii=False)}
+    delta = {}
     
-    Extrait SEULEMENT les nouvelles informations concrètes du message utilisateur.
-    Retourne un JSON avec les clés pertinentes. 
+    budget = _extract_budget(user_message)
+    if budget:
+        delta["budget"] = budget
     
-    Exemples de clés : produit_cherche, budget, usage, taille_logement, animaux, sensibilite_bruit, priorites, contraintes, marque_preferee, etc.
+    words = [word.lower() for word in _WORD_PAT.findall(user_message)]
     
-    Si aucune nouvelle info, retourne {{}}
-    Ne répète pas les infos déjà connues.
-    """
+    brands = [word for word in words if word in KNOWN_BRANDS]
+    if brands:
+        delta["marque_preferee"] = brands[0].title()
     
+    usages = list(dict.fromkeys(USAGE_KEYWORDS[word] for word in words if word in USAGE_KEYWORDS))
+    if usages:
+        delta["usage"] = ", ".join(usages)
+    
+    return delta
+
+@st.cache_resource
+def get_token_encoder() -> tiktoken.Encoding:
+    """Encodeur chargé au premier besoin : son premier chargement télécharge ses tables."""
+    return tiktoken.encoding_for_model("gpt-4o-mini")
+
+def count_message_tokens(messages: List[Dict]) -> List[int]:
+    """Nombre de tokens de chaque message, encodés en un seul lot."""
+    # +4 : surcoût du format de message ; les tokens spéciaux tapés par l'utilisateur
+    # ("<|endoftext|>"...) sont comptés comme du texte au lieu de lever une erreur
+    contents = [msg["content"] for msg in messages]
+    return [len(tokens) + 4 for tokens in get_token_encoder().encode_batch(contents, disallowed_special=())]
+
+def fit_history(messages: List[Dict], budget: int = HISTORY_TOKEN_BUDGET) -> List[Dict]:
+    """Garde les messages les plus récents qui tiennent dans le budget de tokens."""
+    
+    token_counts = count_message_tokens(messages)
+    start = len(messages)
+    used = 0
+    while start > 0 and used + token_counts[start - 1] <= budget:
+        start -= 1
+        used += token_counts[start]
+    return messages[start:]
+
+def _stream_reply(stream, context_delta: Dict) -> Iterator[str]:
+    """Émet le texte de la réponse au fil de l'eau et garde le bloc de contexte final."""
+    
+    buffer = ""
+    in_context = False
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=100,
-            temperature=0.3
-        )
-        
-        result = response.choices[0].message.content.strip()
-        # Nettoyer la réponse pour extraire le JSON
-        if result.startswith('```'):
-            result = result.split('```')[1]
-        if result.startswith('json'):
-            result = result[4:]
-        
-        return json.loads(result)
-    except:
-        return {}
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            buffer += chunk.choices[0].delta.content or ""
+            if in_context:
+                continue
+            
+            marker_pos = buffer.find(CONTEXT_MARKER)
+            if marker_pos >= 0:
+                if buffer[:marker_pos]:
+                    yield buffer[:marker_pos]
+                buffer = buffer[marker_pos + len(CONTEXT_MARKER):]
+                in_context = True
+            else:
+                # Garde en réserve ce qui pourrait être le début du marqueur
+                safe_len = len(buffer) - len(CONTEXT_MARKER) + 1
+                if safe_len > 0:
+                    yield buffer[:safe_len]
+                    buffer = buffer[safe_len:]
+    except Exception:
+        if not in_context:
+            buffer += "\n\nDésolé, j'ai un petit souci technique... Pouvez-vous répéter ? 😅"
+    
+    if not in_context:
+        if buffer:
+            yield buffer
+        return
+    
+    start, end = buffer.find("{"), buffer.rfind("}")
+    try:
+        delta = json.loads(buffer[start:end + 1]) if 0 <= start < end else {}
+    except ValueError:
+        delta = {}
+    if isinstance(delta, dict):
+        context_delta.update(delta)
 
-def chat_with_assistant(user_message: str, conversation_history: List[Dict], user_context: Dict) -> str:
-    """Conversation principale avec l'assistant."""
+def chat_with_assistant(user_message: str, conversation_history: List[Dict], user_context_json: str) -> Tuple[Iterator[str], Dict]:
+    """Conversation principale avec l'assistant.
+    
+    Retourne la réponse d'Alex en streaming et le dictionnaire des nouvelles
+    infos extraites du message utilisateur, rempli une fois le flux consommé.
+    """
     
     context_info = f"""
     INFORMATIONS COLLECTÉES SUR L'UTILISATEUR :
-    {json.dumps(user_context, indent=2, ensure_ascii=False)}
+    {user_context_json}
     
     INSTRUCTIONS SPÉCIALES :
     - Si tu as assez d'informations pour faire une recherche, utilise ce format exact : "cherchons [terme de recherche] entre [prix_min] et [prix_max]"
     - Sinon, pose 1-2 questions naturelles pour mieux cerner les besoins
     - Vulgarise toujours les aspects techniques
     - Reste dans ton rôle d'Alex, conseiller sympa et expert
+    
+    FORMAT DE RÉPONSE :
+    Écris d'abord ta réponse à l'utilisateur, puis termine par une ligne {CONTEXT_MARKER} suivie d'un JSON sur une ligne :
+    {{"produit_cherche"|"budget"|"usage"|"marque_preferee"|"contraintes"|...: "<valeur courte>"}} avec SEULEMENT les nouvelles infos concrètes du dernier message utilisateur, sinon {{}}.
+    Réutilise les clés déjà présentes dans les informations collectées.
     """
     
+    # Le persona, identique à chaque appel, reste en tête pour profiter du cache de prompt
     messages = [
-        {"role": "system", "content": ASSISTANT_PERSONA + "\n\n" + context_info},
+        {"role": "system", "content": ASSISTANT_PERSONA},
+        {"role": "system", "content": context_info},
     ]
     
-    # Historique récent
-    for msg in conversation_history[-8:]:
-        messages.append(msg)
+    # Historique récent, tronqué selon le nombre de tokens
+    messages.extend(fit_history(conversation_history))
     
     messages.append({"role": "user", "content": user_message})
     
+    context_delta = {}
     try:
-        response = client.chat.completions.create(
+        stream = client.chat.completions.create(
             model="gpt-4o-mini",
             messages=messages,
-            max_tokens=300,
-            temperature=0.8
+            temperature=0.8,
+            stream=True
         )
-        return response.choices[0].message.content.strip()
-    except Exception as e:
-        return f"Désolé, j'ai un petit souci technique... Pouvez-vous répéter ? 😅"
+    except Exception:
+        return iter(["Désolé, j'ai un petit souci technique... Pouvez-vous répéter ? 😅"]), context_delta
+    
+    return _stream_reply(stream, context_delta), context_delta
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
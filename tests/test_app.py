@@ -0,0 +1,63 @@
+import importlib
+import os
+import sys
+
+import pytest
+
+for module in ("streamlit", "openai", "dotenv", "diskcache", "tiktoken", "numpy"):
+    pytest.importorskip(module)
+
+# app.py vérifie les clés au chargement ; des valeurs factices suffisent, aucun appel réseau n'est fait
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("SERPAPI_API_KEY", "test")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+app = importlib.import_module("app")
+
+
+@pytest.mark.parametrize("message, budget", [
+    ("Pas plus de 1 500 €", "1500 €"),
+    ("Pas plus de 1\u00a0500 €", "1500 €"),
+    ("1.200 euros maximum", "1200 €"),
+    ("Je vise 80€", "80 €"),
+    ("entre 100 et 300 euros", "100-300 €"),
+    ("entre 100€ et 250€", "100-250 €"),
+    ("mon budget est entre 100 et 200", "100-200 €"),
+    ("budget de 300", "300 €"),
+    ("budget max 1 200", "1200 €"),
+    ("Je veux un budget de 2 000 à 3 000", "2000-3000 €"),
+    ("de 2000 à 3000 €", "2000-3000 €"),
+])
+def test_cheap_context_delta_budget(message, budget):
+    assert app.cheap_context_delta(message)["budget"] == budget
+
+
+@pytest.mark.parametrize("message", [
+    "entre 2 et 3 personnes",
+    "On est 4 à la maison",
+    "12.99 € la recharge",
+    "budget serré pour 2 personnes",
+    "de 2 à 3 personnes",
+    "Pour mes 2 enfants de 8 à 12 ans",
+])
+def test_cheap_context_delta_ignores_non_budget_numbers(message):
+    assert "budget" not in app.cheap_context_delta(message)
+
+
+def test_cheap_context_delta_brand_and_usage():
+    delta = app.cheap_context_delta("Un casque Sony pour le télétravail")
+    assert delta == {"marque_preferee": "Sony", "usage": "télétravail"}
+
+
+def test_cheap_context_delta_empty_message():
+    assert app.cheap_context_delta("Bonjour !") == {}
+
+
+@pytest.mark.parametrize("rating, expected", [(4.5, 4.5), (4, 4.0), ("4,5 sur 5", 4.5), ("4.5 out of 5", 4.5), (None, 0.0)])
+def test_parse_rating(rating, expected):
+    assert app.parse_rating(rating) == expected
+
+
+@pytest.mark.parametrize("reviews, expected", [(1234, 1234), ("1 234", 1234), ("1,234 ratings", 1234), (None, 0)])
+def test_parse_reviews_count(reviews, expected):
+    assert app.parse_reviews_count(reviews) == expected